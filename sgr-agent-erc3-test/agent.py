@@ -1,6 +1,10 @@
 import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import Annotated, List, Union, Literal, Optional
+from typing import Annotated, Any, Callable, Dict, List, Union, Literal, Optional, Tuple
 from annotated_types import MaxLen, MinLen, Gt, Lt
 from erc3.erc3 import ProjectDetail
 from pydantic import BaseModel, Field
@@ -46,6 +50,7 @@ class NextStep(BaseModel):
     task_completed: bool
     # Routing to one of the tools to execute the first remaining step
     # if task is completed, model will pick ReportTaskCompletion
+    # every tool carries its own `tool` literal, so the first arm that validates is the right one
     first_step_from_plan: Union[
         dev.Req_ProvideAgentResponse,
         dev.Req_ListProjects,
@@ -69,104 +74,140 @@ class NextStep(BaseModel):
         CreateTimesheetEntryForUser,
         dev.Req_UpdateTimeEntry,
         Req_DeleteWikiPage,
-    ] = Field(..., description="first step from plan above")
+    ] = Field(..., description="first step from plan above", union_mode="left_to_right")
+
+# lets the model plan a few calls ahead, saving LLM round-trips on multi-hop tasks
+class NextStepBatch(BaseModel):
+    steps: Annotated[List[NextStep], MinLen(1), MaxLen(3)] = Field(..., description="next steps in order; add follow-up steps only if their arguments do not depend on results of earlier ones")
+
+# schema walk over the union is expensive, do it once
+NEXTSTEP_SCHEMA_JSON = json.dumps(NextStep.model_json_schema())
 
 CLI_RED = "\x1B[31m"
 CLI_GREEN = "\x1B[32m"
 CLI_BLUE = "\x1B[34m"
 CLI_CLR = "\x1B[0m"
 
-# custom tool to list my projects
-def list_my_projects(api: Erc3Client, user: str) -> Resp_ListAllProjectsForUser:
-    page_limit = 32
-    next_offset = 0
-    lead_in = []
-    member_of = []
-    while True:
-        try:
-            prjs = api.search_projects(offset=next_offset, limit=page_limit, include_archived=True, team=dict(employee_id=user))
-
-            for p in prjs.projects or []:
-                detail = api.get_project(p.id).project
-                role = [t for t in detail.team if t.employee == user][0].role
-
-                if role == "Lead":
-                    lead_in.append(detail)
-                else:
-                    member_of.append(detail)
-
-            next_offset = prjs.next_offset
-            if next_offset == -1:
-                return Resp_ListAllProjectsForUser(lead_in=lead_in, member_of=member_of)
-        except ApiException as e:
-            if "page limit exceeded" in str(e):
-                page_limit /= 2
-                if page_limit <= 2:
-                    raise
-def list_my_customers(api: Erc3Client, user: str) -> Resp_ListAllCustomersForUser:
-    page_limit = 32
-    next_offset = 0
+# how many requests may be in flight against the API - shared by all tasks and pools
+FETCH_WORKERS = 16
+api_slots = threading.BoundedSemaphore(FETCH_WORKERS)
+
+def throttled(fn: Callable) -> Callable:
+    def call(*args):
+        with api_slots:
+            return fn(*args)
+    return call
+
+# page size to start with per endpoint - start large and remember what the API accepted
+page_hints: Dict[str, int] = {"projects": 128, "customers": 128}
+
+# walks search pages and loads details of found items concurrently.
+# Next page is requested while details of the current one are still loading
+def load_pages(key: str, search: Callable[[int, int], Any], items: Callable[[Any], Optional[List]], load: Callable[[str], Any]) -> List:
+    search, load = throttled(search), throttled(load)
+    page_limit = page_hints[key]
+    offset = 0
     loaded = []
-    while True:
-        try:
-            custs = api.search_customers(offset=next_offset, limit=page_limit, account_managers=[user])
-
-            for p in custs.companies or []:
-                loaded.append(api.get_customer(p.id).company)
-
-            next_offset = custs.next_offset
-            if next_offset == -1:
-                return Resp_ListAllCustomersForUser(customers=loaded)
-        except ApiException as e:
-            if "page limit exceeded" in str(e):
-                page_limit /= 2
-                if page_limit <= 2:
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+        page = pool.submit(search, offset, page_limit)
+        while True:
+            try:
+                found = page.result()
+            except ApiException as e:
+                # detail is the API message itself, no need to format the whole exception
+                if "page limit exceeded" not in (e.detail or "") or page_limit < 2:
                     raise
+                page_limit //= 2
+                page = pool.submit(search, offset, page_limit)
+                continue
 
-# Tool do automatically distill wiki rules
-def distill_rules(api: Erc3Client, llm: MyLLM, about: dev.Resp_WhoAmI) -> str:
-
-    context_id = about.wiki_sha1
-
-    loc = Path(f"context_{context_id}_v2.json")
-
-    Category = Literal["applies_to_guests", "applies_to_users", "other"]
-
-    class Rule(BaseModel):
-        why_relevant_summary: str = Field(...)
-        category: Category = Field(...)
-        compact_rule: str
-
-    class DistillWikiRules(BaseModel):
-        company_name: str
-        company_locations: List[str] = Field(..., description="list of locations where company operates")
-        company_execs: List[str]
-        rules: List[Rule]
-
-    if  not loc.exists():
-        print("New context discovered. Distilling rules once")
-        schema = json.dumps(NextStep.model_json_schema())
-        prompt = f"""
-Carefully review the wiki below and identify most important security/scoping/data rules that will be highly relevant for the agent or user that are automating APIs of this company.
-
-Pay attention to the rules that mention AI Agent or Public ChatBot. When talking about Public Chatbot use - applies_to_guests
-
-Rules must be compact RFC-style, ok to use pseudo code for compactness. They will be used by an agent that operates following APIs: {schema}
-""".strip()
-
-        for path in api.list_wiki().paths:
-            content = api.load_wiki(path)
-            prompt += f"\n---- start of {path} ----\n\n{content}\n\n ---- end of {path} ----\n"
+            page_hints[key] = page_limit
 
+            if found.next_offset != -1:
+                offset = found.next_offset
+                page = pool.submit(search, offset, page_limit)
 
-        messages = [{ "role": "system", "content": prompt}]
+            # map re-raises the first failure in order
+            loaded.extend(pool.map(load, [p.id for p in items(found) or []]))
 
-        distilled = llm.query(messages, DistillWikiRules, "gpt-5.1")
-        loc.write_text(distilled.model_dump_json(indent=2))
+            if found.next_offset == -1:
+                return loaded
 
-    else:
-        distilled = DistillWikiRules.model_validate_json(loc.read_text())
+# custom tool to list my projects
+def list_my_projects(api: Erc3Client, user: str) -> Resp_ListAllProjectsForUser:
+    details = load_pages(
+        "projects",
+        lambda offset, limit: api.search_projects(offset=offset, limit=limit, include_archived=True, team=dict(employee_id=user)),
+        lambda found: found.projects,
+        lambda id: api.get_project(id).project,
+    )
+    lead_in = []
+    member_of = []
+    for detail in details:
+        role = next((t.role for t in detail.team if t.employee == user), None)
+        if role is None:
+            # search index may be stale - user was removed in the meantime
+            continue
+
+        if role == "Lead":
+            lead_in.append(detail)
+        else:
+            member_of.append(detail)
+    # details are already validated by the client, no need to walk them again
+    return Resp_ListAllProjectsForUser.model_construct(lead_in=lead_in, member_of=member_of)
 
+def list_my_customers(api: Erc3Client, user: str) -> Resp_ListAllCustomersForUser:
+    loaded = load_pages(
+        "customers",
+        lambda offset, limit: api.search_customers(offset=offset, limit=limit, account_managers=[user]),
+        lambda found: found.companies,
+        lambda id: api.get_customer(id).company,
+    )
+    return Resp_ListAllCustomersForUser.model_construct(customers=loaded)
+
+Category = Literal["applies_to_guests", "applies_to_users", "other"]
+
+class Rule(BaseModel):
+    why_relevant_summary: str = Field(...)
+    category: Category = Field(...)
+    compact_rule: str
+
+class DistillWikiRules(BaseModel):
+    company_name: str
+    company_locations: List[str] = Field(..., description="list of locations where company operates")
+    company_execs: List[str]
+    rules: List[Rule]
+
+# one lock per wiki, so that distilling one company doesn't hold up tasks of another
+distill_locks: Dict[str, threading.Lock] = {}
+distill_locks_guard = threading.Lock()
+
+def distill_lock(context_id: str) -> threading.Lock:
+    with distill_locks_guard:
+        return distill_locks.setdefault(context_id, threading.Lock())
+
+# bump when DistillWikiRules fields change, so that stale files are ignored
+CONTEXT_VERSION = "v2"
+
+def context_file(context_id: str) -> Path:
+    return Path(f"context_{context_id}_{CONTEXT_VERSION}.json")
+
+# a crash mid-write must not leave a broken cache file behind
+def write_atomic(loc: Path, text: str) -> None:
+    tmp = loc.with_name(f"{loc.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_text(text)
+    os.replace(tmp, loc)
+
+# both variants of the rules prompt are built once per wiki: (public, authenticated)
+@lru_cache(maxsize=8)
+def load_rules_blocks(context_id: str) -> Tuple[str, str]:
+    # we wrote this file ourselves, so skip validation
+    data = json.loads(context_file(context_id).read_text())
+    data["rules"] = [Rule.model_construct(**r) for r in data["rules"]]
+    distilled = DistillWikiRules.model_construct(**data)
+    return rules_block(distilled, True), rules_block(distilled, False)
+
+def rules_block(distilled: DistillWikiRules, is_public: bool) -> str:
     prompt = f"""You are AI Chatbot automating {distilled.company_name}.
     
 Company locations: {distilled.company_locations}
@@ -185,28 +226,76 @@ Use available tools to execute task from the current user.
 # Rules
 """
     relevant_categories: List[Category] = ["other"]
-    if about.is_public:
+    if is_public:
         relevant_categories.append("applies_to_guests")
     else:
         relevant_categories.append("applies_to_users")
 
-    for r in distilled.rules:
-        if r.category in relevant_categories:
-            prompt += f"\n- {r.compact_rule}"
+    prompt += "".join(f"\n- {r.compact_rule}" for r in distilled.rules if r.category in relevant_categories)
+    return prompt
 
-    # append at the end to keep rules in context cache
-    prompt += f"# Current context (trust it)\nDate:{about.today}"
+# built fresh for every task - each task has its own environment and employee data may change
+def actor_block(api: Erc3Client, about: dev.Resp_WhoAmI) -> str:
+    context = f"# Current context (trust it)\nDate:{about.today}"
 
     if about.is_public:
-        prompt += "\nCurrent actor is GUEST (Anonymous user)"
+        context += "\nCurrent actor is GUEST (Anonymous user)"
     else:
         employee = api.get_employee(about.current_user).employee
         employee.skills = []
         employee.wills = []
         dump = employee.model_dump_json()
-        prompt += f"\n# Current actor is authenticated user: {employee.name}:\n{dump}"
+        context += f"\n# Current actor is authenticated user: {employee.name}:\n{dump}"
+    return context
 
-    return prompt
+# one-off LLM pass over the whole wiki, result is stored in loc
+def distill_wiki(api: Erc3Client, llm: MyLLM, loc: Path):
+    print("New context discovered. Distilling rules once")
+    prompt = f"""
+Carefully review the wiki below and identify most important security/scoping/data rules that will be highly relevant for the agent or user that are automating APIs of this company.
+
+Pay attention to the rules that mention AI Agent or Public ChatBot. When talking about Public Chatbot use - applies_to_guests
+
+Rules must be compact RFC-style, ok to use pseudo code for compactness. They will be used by an agent that operates following APIs: {NEXTSTEP_SCHEMA_JSON}
+""".strip()
+
+    # pages are independent requests, load them in parallel and join in the original order
+    paths = api.list_wiki().paths
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+        contents = pool.map(throttled(api.load_wiki), paths)
+        parts = [prompt]
+        for path, content in zip(paths, contents):
+            parts.append(f"\n---- start of {path} ----\n\n{content}\n\n ---- end of {path} ----\n")
+    prompt = "".join(parts)
+
+    messages = [{ "role": "system", "content": prompt}]
+
+    distilled = llm.query(messages, DistillWikiRules, "gpt-5.1")
+    write_atomic(loc, distilled.model_dump_json())
+
+# Tool do automatically distill wiki rules
+# returns (rules, context) - rules are static per wiki and go first to hit the provider prompt cache
+def distill_rules(api: Erc3Client, llm: MyLLM, about: dev.Resp_WhoAmI) -> Tuple[str, str]:
+
+    context_id = about.wiki_sha1
+
+    loc = context_file(context_id)
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        # actor lookup is a network call, overlap it with loading the rules
+        actor = pool.submit(actor_block, api, about)
+
+        # tasks may run concurrently, distill each wiki only once
+        if not loc.exists():
+            with distill_lock(context_id):
+                if not loc.exists():
+                    distill_wiki(api, llm, loc)
+
+        public_rules, authed_rules = load_rules_blocks(context_id)
+        rules = public_rules if about.is_public else authed_rules
+
+        # keep context separate from the rules, so that the shared prefix stays byte-identical
+        return rules, actor.result()
 
 
 def my_dispatch(client: Erc3Client, cmd: BaseModel, about: dev.Resp_WhoAmI):
@@ -239,28 +328,119 @@ def my_dispatch(client: Erc3Client, cmd: BaseModel, about: dev.Resp_WhoAmI):
 
     return client.dispatch(cmd)
 
+# tools that don't change state, their results can be reused within a task
+READ_ONLY_TOOLS = (
+    dev.Req_ListProjects,
+    dev.Req_SearchProjects,
+    Req_ListAllProjectsForUser,
+    dev.Req_GetProject,
+    dev.Req_ListEmployees,
+    dev.Req_SearchEmployees,
+    dev.Req_GetEmployee,
+    dev.Req_ListCustomers,
+    Req_ListAllCustomersForUser,
+    dev.Req_GetCustomer,
+    dev.Req_SearchCustomers,
+    dev.Req_SearchTimeEntries,
+    dev.Req_TimeSummaryByProject,
+    dev.Req_TimeSummaryByEmployee,
+    dev.Req_GetTimeEntry,
+)
+
+# agents tend to repeat the same lookups across steps, so skip the round-trip for those.
+# Results are kept serialized - responses come from the API already validated, so
+# there is no point in dumping them again on every hit
+class ToolCache:
+    def __init__(self) -> None:
+        self.results: Dict[str, str] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def dispatch(self, client: Erc3Client, cmd: BaseModel, about: dev.Resp_WhoAmI) -> str:
+        if not isinstance(cmd, READ_ONLY_TOOLS):
+            # any write might affect cached reads
+            self.results.clear()
+            return dump_result(my_dispatch(client, cmd, about))
+
+        key = f"{cmd.__class__.__name__}:{cmd.model_dump_json()}"
+        if key in self.results:
+            self.hits += 1
+            return self.results[key]
+
+        self.misses += 1
+        txt = dump_result(my_dispatch(client, cmd, about))
+        self.results[key] = txt
+        return txt
+
+def dump_result(result: BaseModel) -> str:
+    return result.model_dump_json(exclude_none=True, exclude_unset=True)
+
+DenialReason = Literal["security_violation", "request_not_supported_by_api", "possible_security_violation_check_project", "may_pass"]
+
+class RequestPreflightCheck(BaseModel):
+    current_actor: str
+    preflight_check_explanation_brief: Optional[str]
+    denial_reason: DenialReason
+    outcome_confidence_1_to_5: Annotated[int, Gt(0), Lt(6)]
+
+# preflight and the first planning step see the same prompt, so ask for both in one call.
+# Plan is ignored if preflight denies the request
+class PreflightAndPlan(BaseModel):
+    preflight: RequestPreflightCheck
+    plan: NextStepBatch
+
+# tool outputs above this size are summarized once they are a few messages old
+MAX_OLD_TOOL_OUTPUT = 4096
+KEEP_RECENT_MESSAGES = 4
+# how often to compact, every pass breaks the cached prompt prefix at the first rewritten message
+COMPACT_EVERY_STEPS = 5
+
+# short description of what was dropped: list sizes with their first ids and small scalar fields
+def summarize_tool_output(name: str, content: str) -> str:
+    parts = [f"{name} output, {len(content)} chars"]
+    try:
+        data = json.loads(content.removeprefix("DONE: "))
+    except ValueError:
+        data = None
+
+    if isinstance(data, dict):
+        for field, value in data.items():
+            if isinstance(value, list):
+                ids = [str(v["id"]) for v in value[:5] if isinstance(v, dict) and "id" in v]
+                more = ", ..." if len(value) > len(ids) and ids else ""
+                listed = f" (ids: {', '.join(ids)}{more})" if ids else ""
+                parts.append(f"{field}: {len(value)} items{listed}")
+            elif not isinstance(value, dict) and len(str(value)) <= 64:
+                parts.append(f"{field}: {value}")
+
+    return f"[summary of {'; '.join(parts)}. Repeat the call to see it in full]"
+
+# keeps prefill cost in check on long tasks. All aged outputs are summarized in one
+# batch, so the provider cache is invalidated once per pass instead of on every step
+def compact_log(log: List[dict]) -> None:
+    names = {call["id"]: call["function"]["name"] for msg in log for call in msg.get("tool_calls", [])}
+    for msg in log[:-KEEP_RECENT_MESSAGES]:
+        if msg["role"] == "tool" and len(msg["content"]) > MAX_OLD_TOOL_OUTPUT:
+            msg["content"] = summarize_tool_output(names.get(msg["tool_call_id"], "tool"), msg["content"])
+
 def run_agent(model: str, api: ERC3, task: TaskInfo):
     erc_client = api.get_erc_client(task)
     about = erc_client.who_am_i()
     llm = MyLLM(api=api, model=model, task=task, max_tokens=32768)
+    cache = ToolCache()
 
-    system_prompt = distill_rules(erc_client, llm, about)
-
-    reason = Literal["security_violation", "request_not_supported_by_api", "possible_security_violation_check_project", "may_pass"]
-
-    class RequestPreflightCheck(BaseModel):
-        current_actor: str
-        preflight_check_explanation_brief: Optional[str]
-        denial_reason: reason
-        outcome_confidence_1_to_5: Annotated[int, Gt(0), Lt(6)]
+    rules_prompt, context_prompt = distill_rules(erc_client, llm, about)
 
     # log will contain conversation context for the agent within task
+    # static rules go first, so that the provider can cache them across steps and tasks
     log = [
-        {"role": "system", "content": system_prompt},
+        {"role": "system", "content": rules_prompt},
+        {"role": "system", "content": context_prompt},
         {"role": "user", "content": f"Request: '{task.task_text}'"},
     ]
 
-    preflight_check = llm.query(log, RequestPreflightCheck)
+    first = llm.query(log, PreflightAndPlan)
+    preflight_check = first.preflight
     confidence = preflight_check.outcome_confidence_1_to_5
 
     if confidence >=4:
@@ -272,14 +452,25 @@ def run_agent(model: str, api: ERC3, task: TaskInfo):
             erc_client.provide_agent_response("Security check failed", outcome="denied_security")
             return
 
-    log.append({"role": "system", "content": preflight_check.preflight_check_explanation_brief})
+    # only append to the log - anything changed in the middle invalidates the cached prefix.
+    # The one exception is compact_log, which trades that for a shorter prompt every few steps
+    if preflight_check.preflight_check_explanation_brief:
+        log.append({"role": "assistant", "content": preflight_check.preflight_check_explanation_brief})
+
+    queued: List[NextStep] = list(first.plan.steps)
 
     # let's limit number of reasoning steps by 20, just to be safe
     for i in range(20):
         step = f"step_{i + 1}"
         print(f"Next {step}... ", end="")
 
-        job = llm.query(log, NextStep)
+        # first planned step always runs, planned-ahead lookups run without asking
+        # the model again, anything else needs a fresh look
+        if queued and (i == 0 or isinstance(queued[0].first_step_from_plan, READ_ONLY_TOOLS)):
+            job = queued.pop(0)
+        else:
+            queued = []
+            job = llm.query(log, NextStep)
 
           # print next sep for debugging
         print(job.plan_remaining_steps_brief[0], f"\n  {job.first_step_from_plan}")
@@ -300,8 +491,7 @@ def run_agent(model: str, api: ERC3, task: TaskInfo):
 
         # now execute the tool by dispatching command to our handler
         try:
-            result = my_dispatch(erc_client, job.first_step_from_plan, about)
-            txt = result.model_dump_json(exclude_none=True, exclude_unset=True)
+            txt = cache.dispatch(erc_client, job.first_step_from_plan, about)
             print(f"{CLI_GREEN}OUT{CLI_CLR}: {txt}")
             txt = "DONE: " + txt
         except ApiException as e:
@@ -310,6 +500,8 @@ def run_agent(model: str, api: ERC3, task: TaskInfo):
             print(f"{CLI_RED}ERR: {e.api_error.error}{CLI_CLR}")
 
             txt = "ERROR: " + txt
+            # the rest of the plan was made without this error
+            queued = []
 
             # if SGR wants to finish, then quit loop
         if isinstance(job.first_step_from_plan, dev.Req_ProvideAgentResponse):
@@ -321,4 +513,8 @@ def run_agent(model: str, api: ERC3, task: TaskInfo):
 
         # and now we add results back to the convesation history, so that agent
         # we'll be able to act on the results in the next reasoning step.
-        log.append({"role": "tool", "content": txt, "tool_call_id": step})
\ No newline at end of file
+        log.append({"role": "tool", "content": txt, "tool_call_id": step})
+        if (i + 1) % COMPACT_EVERY_STEPS == 0:
+            compact_log(log)
+
+    print(f"Tool cache: {cache.hits} hits, {cache.misses} misses")
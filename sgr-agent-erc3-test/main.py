@@ -1,8 +1,12 @@
+import io
+import sys
 import textwrap
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from openai import OpenAI
 from agent import run_agent
-from erc3 import ERC3
+from erc3 import ERC3, TaskInfo
 
 client = OpenAI()
 core = ERC3()
@@ -25,19 +29,53 @@ res = core.start_session(
 status = core.session_status(res.session_id)
 print(f"Session has {len(status.tasks)} tasks")
 
-for task in status.tasks:
-    print("="*40)
-    print(f"Starting Task: {task.task_id} ({task.spec_id}): {task.task_text}")
-    # start the task
-    core.start_task(task)
+# tasks are independent and mostly wait on the network, so run them concurrently
+TASK_WORKERS = 8
+print_lock = threading.Lock()
+
+# everything a task prints (including the agent itself) goes into a buffer of its
+# worker thread, so that the output of concurrent tasks doesn't interleave
+class TaskOutput(io.TextIOBase):
+    def __init__(self, stream) -> None:
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text: str) -> int:
+        return (getattr(self.local, "buffer", None) or self.stream).write(text)
+
+    def flush(self) -> None:
+        self.stream.flush()
+
+output = TaskOutput(sys.stdout)
+sys.stdout = output
+
+def run_and_complete(model: str, task: TaskInfo):
+    buffer = io.StringIO()
+    output.local.buffer = buffer
     try:
-        run_agent(MODEL_ID, core, task)
-    except Exception as e:
-        print(e)
-    result = core.complete_task(task)
-    if result.eval:
-        explain = textwrap.indent(result.eval.logs, "  ")
-        print(f"\nSCORE: {result.eval.score}\n{explain}\n")
+        print("="*40)
+        print(f"Starting Task: {task.task_id} ({task.spec_id}): {task.task_text}")
+        # start the task
+        core.start_task(task)
+        try:
+            run_agent(model, core, task)
+        except Exception as e:
+            print(f"Task {task.task_id} failed: {e}")
+        result = core.complete_task(task)
+        if result.eval:
+            explain = textwrap.indent(result.eval.logs, "  ")
+            print(f"\nSCORE ({task.task_id}): {result.eval.score}\n{explain}\n")
+        return result
+    finally:
+        output.local.buffer = None
+        with print_lock:
+            output.stream.write(buffer.getvalue())
+            output.stream.flush()
+
+with ThreadPoolExecutor(max_workers=TASK_WORKERS) as pool:
+    futures = [pool.submit(run_and_complete, MODEL_ID, task) for task in status.tasks]
+    for future in as_completed(futures):
+        future.result()
 
 core.submit_session(res.session_id)
 
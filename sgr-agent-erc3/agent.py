@@ -15,6 +15,7 @@ class NextStep(BaseModel):
     task_completed: bool
     # Routing to one of the tools to execute the first remaining step
     # if task is completed, model will pick ReportTaskCompletion
+    # every tool carries its own `tool` literal, so the first arm that validates is the right one
     function: Union[
         dev.Req_ProvideAgentResponse,
         dev.Req_ListProjects,
@@ -35,7 +36,7 @@ class NextStep(BaseModel):
         dev.Req_UpdateEmployeeInfo,
         dev.Req_TimeSummaryByProject,
         dev.Req_TimeSummaryByEmployee,
-    ] = Field(..., description="execute first remaining step")
+    ] = Field(..., description="execute first remaining step", union_mode="left_to_right")
 
 
 